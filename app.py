@@ -1,7 +1,7 @@
 # app.py
 import streamlit as st
 import document_processor as dp
-import json
+import orjson
 import traceback
 import pandas as pd
 import time
@@ -28,7 +28,7 @@ st.markdown(f"**LLM Model:** `{dp.MODEL_NAME}` (Configurable in `document_proces
 st.markdown("Analyzes the hierarchical structure of Thai legal documents using a 3-step pipeline with auto-retry and performance monitoring.")
 
 with st.expander("⚙️ Edit Prompts for Each Step"):
-    tab1, tab2, tab3 = st.tabs(["Step 1: Architect", "Step 2: Surveyor", "Step 3: Detailer"])
+    tab1, tab2, tab3, tab4 = st.tabs(["Step 1: Architect", "Step 2: Surveyor", "Step 3: Detailer", "Single Pass (Small Docs)"])
     with tab1:
         st.info("Defines the task to find top-level structures (Book, Part, Chapter) in the entire document.")
         st.session_state.prompt1 = st.text_area("Architect Prompt", value=dp.PROMPT_ARCHITECT, height=250)
@@ -38,6 +38,9 @@ with st.expander("⚙️ Edit Prompts for Each Step"):
     with tab3:
         st.info("Defines the task to find the lowest-level structures (Article) within the smallest parent block.")
         st.session_state.prompt3 = st.text_area("Detailer Prompt", value=dp.PROMPT_DETAILER, height=250)
+    with tab4:
+        st.info(f"Used instead of the 3 steps for documents up to {dp.SINGLE_PASS_MAX_CHARS:,} characters: finds every header in one call.")
+        st.session_state.prompt_single_pass = st.text_area("Single Pass Prompt", value=dp.PROMPT_SINGLE_PASS, height=250)
 
 uploaded_file = st.file_uploader("Upload a Thai legal document (.txt)", type=['txt'])
 
@@ -54,9 +57,14 @@ if uploaded_file is not None:
             status_container = st.session_state.get('status_container')
             if not status_container: return
             
-            llm_duration = next((item.get('llm_duration_seconds', 0) for item in st.session_state.debug_info if "step1_architect_response" in item), 0)
+            # Large documents log one step1_architect_chunk_N_response per chunk and small ones a
+            # step1_single_pass_response; sum every Step 1 call.
+            debug_info = st.session_state.debug_info
+            llm_duration = dp._stage_llm_seconds(debug_info, "step1_")
+            single_pass = (any("step1_single_pass_response" in item for item in debug_info)
+                           and not any("step1_single_pass_fallback" in item for item in debug_info))
             status_container.write(f"✅ Step 1 Complete! (LLM call: {llm_duration:.2f}s)")
-            status_container.write("Found top-level structures:")
+            status_container.write("Found structures (single pass, all levels):" if single_pass else "Found top-level structures:")
             display_data = [{"type": n.get('type'), "title": n.get('title')} for n in result]
             container = st.empty()
             container.dataframe(display_data)
@@ -69,7 +77,8 @@ if uploaded_file is not None:
                     document_text=document_text, api_key=api_key, status_container=status,
                     prompt_architect=st.session_state.prompt1, prompt_surveyor=st.session_state.prompt2,
                     prompt_detailer=st.session_state.prompt3, debug_info=st.session_state.debug_info,
-                    intermediate_callback=display_intermediate_result
+                    intermediate_callback=display_intermediate_result,
+                    prompt_single_pass=st.session_state.prompt_single_pass
                 )
                 
                 st.session_state.analysis_result = {
@@ -108,8 +117,10 @@ if st.session_state.analysis_result:
             st.subheader("📊 Performance Summary")
             col1, col2, col3, col4 = st.columns(4)
             col1.metric("Step 1 (Architect)", f"{timings.get('step1_architect_duration', 0):.2f} s")
-            col2.metric("Step 2 (Surveyor)", f"{timings.get('step2_surveyor_duration', 0):.2f} s")
-            col3.metric("Step 3 (Detailer)", f"{timings.get('step3_detailer_duration', 0):.2f} s")
+            col2.metric("Step 2 (Surveyor)", f"{timings.get('step2_surveyor_duration', 0):.2f} s",
+                        help="Summed LLM time of all Surveyor calls; they overlap with the other steps.")
+            col3.metric("Step 3 (Detailer)", f"{timings.get('step3_detailer_duration', 0):.2f} s",
+                        help="Summed LLM time of all Detailer calls; they overlap with the other steps.")
             col4.metric(f"Short Nodes (<{short_node_threshold} chars)", f"{total_short_nodes}",
                         help=f"Number of nodes with less than {short_node_threshold} characters of text.",
                         delta=f"-{total_short_nodes}" if total_short_nodes > 0 else None,
@@ -122,7 +133,7 @@ if st.session_state.analysis_result:
         st.json(final_result_data, expanded=True)
         st.download_button(
            label="Download Tree (JSON)",
-           data=json.dumps(final_result_data, indent=2, ensure_ascii=False),
+           data=orjson.dumps(final_result_data, option=orjson.OPT_INDENT_2),
            file_name=f"{file_name.split('.')[0]}_pipeline_tree.json",
            mime="application/json",
         )
@@ -132,7 +143,7 @@ if st.session_state.analysis_result:
         st.json({"pipeline_logs": debug_info}, expanded=False)
         st.download_button(
            label="Download Debug Log (JSON)",
-           data=json.dumps(debug_info, indent=2, ensure_ascii=False),
+           data=orjson.dumps(debug_info, option=orjson.OPT_INDENT_2),
            file_name=f"{file_name.split('.')[0]}_pipeline_debug.json",
            mime="application/json",
         )
\ No newline at end of file
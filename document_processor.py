@@ -1,20 +1,65 @@
 # document_processor.py
 import google.generativeai as genai
-import json
+import asyncio
+import hashlib
+import orjson
+import os
+import re
+import tempfile
 import traceback
 import time
-from google.api_core.exceptions import InternalServerError
+from operator import itemgetter
+from google.api_core.exceptions import InternalServerError, ResourceExhausted, ServiceUnavailable
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential, wait_random
 
 # ==============================================================================
 # [ CONFIGURATION ]
 # ==============================================================================
 MODEL_NAME = "gemini-2.5-flash"
+ARCHITECT_CHUNK_SIZE = 200000  # Larger documents are split and the pieces scanned by the Architect in parallel
 DETAIL_CHUNK_SIZE_THRESHOLD = 30000
+SINGLE_PASS_MAX_CHARS = 80000  # Documents up to this size are structured with one LLM call
+MAX_CONCURRENT_REQUESTS = 8  # Global cap on in-flight LLM calls (keep under the RPM limit)
+QUEUE_MAXSIZE = MAX_CONCURRENT_REQUESTS * 2  # Backpressure between pipeline stages
+MAX_RETRIES = 5
+MAX_BACKOFF_SECONDS = 32
+# 500 / 429 / 503 are transient; anything else is treated as a hard failure for that chunk.
+RETRYABLE_ERRORS = (InternalServerError, ResourceExhausted, ServiceUnavailable)
+DEBUG_VERBOSE = False  # Keep full LLM responses in debug_info instead of a head/tail excerpt
+DEBUG_RESPONSE_EXCERPT_CHARS = 500
+LLM_CACHE_DIR = ".llm_cache"  # On-disk response cache; set to None to disable
+LLM_CACHE_TTL_SECONDS = 7 * 86400
+PROMPT_VERSION = "v2"  # Bump to invalidate cached responses after changing how prompts are built
 
 TYPE_MAPPING = {
     "ภาค": "book", "ลักษณะ": "part", "หมวด": "chapter",
     "ส่วน": "section", "มาตรา": "article"
 }
+REQUIRED_NODE_KEYS = frozenset(("type", "title", "start_index"))
+# Nesting depth of each type in the final tree (book/part/chapter share the top level, as the Architect returns them flat).
+HIERARCHY_LEVELS = {"preamble": 0, "book": 0, "part": 0, "chapter": 0, "section": 1, "article": 2}
+# Native JSON mode: Gemini returns a bare array matching this schema instead of fenced markdown.
+HEADER_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {"type": {"type": "STRING"}, "title": {"type": "STRING"}, "start_index": {"type": "INTEGER"}},
+        "required": ["type", "title", "start_index"],
+    },
+}
+GENERATION_CONFIG = {"response_mime_type": "application/json", "response_schema": HEADER_SCHEMA, "temperature": 0}
+# Output caps per stage; generous because Gemini 2.5 thinking tokens count against the same budget.
+ARCHITECT_GENERATION_CONFIG = {**GENERATION_CONFIG, "max_output_tokens": 8192}
+SURVEYOR_GENERATION_CONFIG = {**GENERATION_CONFIG, "max_output_tokens": 16384}
+DETAILER_GENERATION_CONFIG = {**GENERATION_CONFIG, "max_output_tokens": 16384}
+SINGLE_PASS_GENERATION_CONFIG = {**GENERATION_CONFIG, "max_output_tokens": 32768}
+# Cheap local pre-filters: text without any header keyword for a stage is not sent to the LLM.
+TOP_LEVEL_HEADER_RE = re.compile("ภาค|ลักษณะ|หมวด")
+ANY_HEADER_RE = re.compile("ภาค|ลักษณะ|หมวด|ส่วน|มาตรา")
+SECTION_HEADER_RE = re.compile("ส่วน")
+ARTICLE_HEADER_RE = re.compile("มาตรา")
+# Greedy alternatives end at the last paragraph break, else the last sentence end, else the last space.
+CHUNK_BREAK_RE = re.compile(r".*\n\n|.*\. |.* ", re.S)
 
 PROMPT_ARCHITECT = """You are a top-level document architect for Thai legal codes. Your mission is to identify ONLY the highest-level structural blocks.
 1. Analyze the entire document text provided.
@@ -44,6 +89,15 @@ PROMPT_DETAILER = """You are a meticulous clerk for a Thai legal section. Your m
 
 [SECTION/CHAPTER TEXT]
 {text_chunk}"""
+
+PROMPT_SINGLE_PASS = """You are a document architect for Thai legal codes. Your mission is to list EVERY structural header in a short document.
+1. Analyze the entire document text provided.
+2. Identify all headers for 'ภาค' (book), 'ลักษณะ' (part), 'หมวด' (chapter), 'ส่วน' (section), and 'มาตรา' (article).
+3. For each header found, create a JSON object with `type`, `title`, and its `start_index`.
+4. Return a single, flat JSON array of these objects in document order. If no headers are found, return an empty array `[]`.
+
+[DOCUMENT TEXT]
+{text_chunk}"""
 # ==============================================================================
 # [ END OF CONFIGURATION ]
 # ==============================================================================
@@ -52,15 +106,88 @@ PROMPT_DETAILER = """You are a meticulous clerk for a Thai legal section. Your m
 def extract_json_from_response(text):
     if not text:
         return None
-    if '```json' in text:
+    fence = text.find('```json')
+    if fence != -1:
+        body_start = fence + len('```json')
+        body_end = text.find('```', body_start)
         try:
-            return json.loads(text.split('```json', 1)[1].split('```', 1)[0].strip())
-        except (json.JSONDecodeError, IndexError):
+            return orjson.loads(text[body_start:body_end if body_end != -1 else len(text)].strip())
+        except orjson.JSONDecodeError:
             pass
     try:
-        return json.loads(text)
-    except json.JSONDecodeError:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
+    # Tolerate commentary around an unfenced array, e.g. "Here are the headers: [...] Done."
+    array_start, array_end = text.find('['), text.rfind(']')
+    if array_start != -1 and array_end > array_start:
+        try:
+            return orjson.loads(text[array_start:array_end + 1])
+        except orjson.JSONDecodeError:
+            pass
+    return None
+
+def _llm_cache_path(prompt):
+    key = hashlib.sha256(f"{MODEL_NAME}|{PROMPT_VERSION}|{prompt}".encode()).hexdigest()
+    return os.path.join(LLM_CACHE_DIR, f"{key}.txt")
+
+def _llm_cache_get(prompt):
+    if not LLM_CACHE_DIR:
         return None
+    path = _llm_cache_path(prompt)
+    try:
+        if time.time() - os.path.getmtime(path) > LLM_CACHE_TTL_SECONDS:
+            os.remove(path)
+            return None
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _llm_cache_put(prompt, response_text):
+    if not LLM_CACHE_DIR:
+        return
+    path = _llm_cache_path(prompt)
+    try:
+        os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+        # Write-then-rename so a concurrent reader never sees a half-written entry; mkstemp gives every
+        # writer its own temp file (Streamlit sessions are threads of one process).
+        fd, tmp_path = tempfile.mkstemp(dir=LLM_CACHE_DIR, suffix=".tmp")
+        try:
+            with open(fd, "w", encoding="utf-8") as f:
+                f.write(response_text)
+            os.replace(tmp_path, path)
+        except OSError:
+            os.remove(tmp_path)
+            raise
+    except OSError:
+        pass
+
+def _llm_cache_evict(prompt):
+    if not LLM_CACHE_DIR:
+        return
+    try:
+        os.remove(_llm_cache_path(prompt))
+    except OSError:
+        pass
+
+def _debug_excerpt(text):
+    if DEBUG_VERBOSE or len(text) <= 2 * DEBUG_RESPONSE_EXCERPT_CHARS:
+        return text
+    return text[:DEBUG_RESPONSE_EXCERPT_CHARS] + "…" + text[-DEBUG_RESPONSE_EXCERPT_CHARS:]
+
+class TextSlice:
+    # Lazy view of doc[start:end]; the substring is only materialized when the prompt is built.
+    __slots__ = ("doc", "start", "end")
+
+    def __init__(self, doc, start, end):
+        self.doc, self.start, self.end = doc, start, end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __str__(self):
+        return self.doc[self.start:self.end]
 
 def chunk_text_semantic(text, chunk_size_chars=30000, overlap_chars=3000):
     if len(text) <= chunk_size_chars:
@@ -70,142 +197,360 @@ def chunk_text_semantic(text, chunk_size_chars=30000, overlap_chars=3000):
     while start_char < len(text):
         ideal_end = start_char + chunk_size_chars
         if ideal_end >= len(text):
-            chunks.append({"start_char": start_char, "text": text[start_char:]})
+            chunks.append({"start_char": start_char, "text": TextSlice(text, start_char, len(text))})
             break
-        separators = ["\n\n", ". ", " ", ""]
-        actual_end = -1
-        for sep in separators:
-            actual_end = text.rfind(sep, start_char, ideal_end)
-            if actual_end != -1:
-                break
-        actual_end = ideal_end if actual_end == -1 else actual_end + len(sep)
-        chunks.append({"start_char": start_char, "text": text[start_char:actual_end]})
-        start_char = actual_end - overlap_chars
+        # Only breaks past the overlap count; otherwise the next chunk would start at or before this one.
+        match = CHUNK_BREAK_RE.match(text, start_char + overlap_chars, ideal_end)
+        actual_end = match.end() if match else ideal_end
+        chunks.append({"start_char": start_char, "text": TextSlice(text, start_char, actual_end)})
+        start_char = max(actual_end - overlap_chars, start_char + 1)
     return chunks
 
 def postprocess_nodes(nodes, parent_text, global_offset=0):
     if not nodes:
         return []
     parent_end = global_offset + len(parent_text)
-    scoped_nodes = [node for node in nodes if 'global_start' in node and global_offset <= node['global_start'] < parent_end]
-    unique_nodes = sorted(list({node['global_start']: node for node in scoped_nodes}.values()), key=lambda x: x['global_start'])
-    for i in range(len(unique_nodes) - 1):
-        unique_nodes[i]['global_end'] = unique_nodes[i+1]['global_start']
+    scoped_nodes = sorted((node for node in nodes if 'global_start' in node and global_offset <= node['global_start'] < parent_end),
+                          key=itemgetter('global_start'))
+    unique_nodes = []
+    for node in scoped_nodes:
+        if unique_nodes and unique_nodes[-1]['global_start'] == node['global_start']:
+            unique_nodes[-1] = node  # Last duplicate wins
+            continue
+        if unique_nodes:
+            unique_nodes[-1]['global_end'] = node['global_start']
+        unique_nodes.append(node)
     if unique_nodes:
         unique_nodes[-1]['global_end'] = parent_end
     for node in unique_nodes:
-        local_start = node['global_start'] - global_offset
-        local_end = node['global_end'] - global_offset
-        node['text'] = parent_text[local_start:local_end]
+        node['text'] = parent_text[node['global_start'] - global_offset:node['global_end'] - global_offset]
         node['children'] = []
     return unique_nodes
 
-def _extract_structure(text_chunk, global_offset, model, safety_settings, prompt_template, debug_info, step_name):
+async def _generate_text(model, prompt, safety_settings, generation_config, semaphore, debug_info, step_name):
+    async with semaphore:
+        start_time = time.perf_counter()
+        if hasattr(model, "generate_content_async"):
+            response = await model.generate_content_async(prompt, safety_settings=safety_settings, generation_config=generation_config)
+        else:
+            # Older SDKs only ship the blocking call; the GIL is released during network I/O,
+            # so a worker thread per in-flight request (bounded by the semaphore) is enough.
+            response = await asyncio.to_thread(model.generate_content, prompt, safety_settings=safety_settings, generation_config=generation_config)
+        duration = time.perf_counter() - start_time
+    try:
+        return response.text, duration
+    except ValueError:
+        debug_info.append({f"{step_name}_generation_error": f"Response blocked or empty. Finish reason: {response.prompt_feedback}"})
+        return "", duration
+
+def _retrying(debug_info, step_name):
+    def log_failed_attempt(retry_state):
+        debug_info.append({f"{step_name}_retryable_error": f"Attempt {retry_state.attempt_number} failed: {retry_state.outcome.exception()}"})
+    # Exponential backoff with jitter so concurrent workers don't retry in lockstep.
+    return AsyncRetrying(stop=stop_after_attempt(MAX_RETRIES),
+                         wait=wait_exponential(max=MAX_BACKOFF_SECONDS) + wait_random(0, 1),
+                         retry=retry_if_exception_type(RETRYABLE_ERRORS),
+                         after=log_failed_attempt, reraise=True)
+
+async def _extract_structure(text_chunk, global_offset, model, safety_settings, prompt_template, debug_info, step_name, semaphore,
+                             header_re=None, generation_config=GENERATION_CONFIG):
+    text_chunk = str(text_chunk)  # Materialise a TextSlice once; the regex and the prompt share the copy
+    if header_re is not None and not header_re.search(text_chunk):
+        debug_info.append({f"{step_name}_skipped": "No header keyword in text; LLM call skipped."})
+        return []
     extracted_nodes = []
-    retries = 3
-    for attempt in range(retries):
-        try:
-            prompt = prompt_template.format(text_chunk=text_chunk)
-            start_time = time.perf_counter()
-            response = model.generate_content(prompt, safety_settings=safety_settings)
-            end_time = time.perf_counter()
-            duration = end_time - start_time
-            
-            response_text = ""
-            try:
-                response_text = response.text
-            except ValueError:
-                debug_info.append({f"{step_name}_generation_error": f"Response blocked or empty. Finish reason: {response.prompt_feedback}"})
-
-            debug_info.append({f"{step_name}_response": response_text, "llm_duration_seconds": duration})
-            nodes_in_chunk = extract_json_from_response(response_text)
-
-            if isinstance(nodes_in_chunk, list):
-                for node in nodes_in_chunk:
-                    if isinstance(node, dict) and all(k in node for k in ['type', 'title', 'start_index']):
-                        node['type'] = TYPE_MAPPING.get(node['type'], node['type'])
-                        node['global_start'] = node['start_index'] + global_offset
-                        extracted_nodes.append(node)
-            else:
-                if response_text: # Only log parsing error if there was text to parse
-                    debug_info.append({f"{step_name}_parsing_error": "Response was not a valid JSON list."})
-            
-            return extracted_nodes
+    try:
+        # Plain substitution: prompts edited in the UI may contain literal braces (e.g. JSON examples).
+        prompt = prompt_template.replace("{text_chunk}", text_chunk)
+        response_text = _llm_cache_get(prompt)
+        from_cache = response_text is not None
+        if from_cache:
+            duration = 0.0
+            debug_info.append({f"{step_name}_cache_hit": "Reused cached LLM response"})
+        else:
+            async for attempt in _retrying(debug_info, step_name):
+                with attempt:
+                    response_text, duration = await _generate_text(model, prompt, safety_settings, generation_config, semaphore, debug_info, step_name)
+
+        debug_info.append({f"{step_name}_response": _debug_excerpt(response_text), "llm_duration_seconds": duration})
+        nodes_in_chunk = extract_json_from_response(response_text)
+
+        if isinstance(nodes_in_chunk, list):
+            if not from_cache:
+                # Only parseable answers are cached, so a malformed one is retried on the next run.
+                _llm_cache_put(prompt, response_text)
+            map_type = TYPE_MAPPING.get
+            for node in nodes_in_chunk:
+                if isinstance(node, dict) and REQUIRED_NODE_KEYS <= node.keys():
+                    node['type'] = map_type(node['type'], node['type'])
+                    node['global_start'] = node['start_index'] + global_offset
+                    extracted_nodes.append(node)
+        else:
+            if from_cache:
+                _llm_cache_evict(prompt)  # Never replay an unparseable entry
+            if response_text: # Only log parsing error if there was text to parse
+                # The _response entry above is only an excerpt; keep the full text when it failed to parse.
+                debug_info.append({f"{step_name}_parsing_error": "Response was not a valid JSON list.", "full_response": response_text})
         
-        except InternalServerError as e:
-            debug_info.append({f"{step_name}_retryable_error": f"Attempt {attempt + 1} failed: {e}"})
-            if attempt < retries - 1:
-                time.sleep(2)
-            else:
-                raise e
-        except Exception as e:
-            debug_info.append({f"{step_name}_critical_error": traceback.format_exc()})
-            return []
-    return []
+        return extracted_nodes
 
-def run_pipeline(document_text, api_key, status_container, 
-                 prompt_architect, prompt_surveyor, prompt_detailer,
-                 debug_info, intermediate_callback=None):
-    
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(MODEL_NAME)
-    safety_settings = { "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE", "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
-                      "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_NONE", "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_NONE" }
-    
-    timings = {}
+    except InternalServerError:
+        raise  # Retries exhausted; fail the run as before (429/503 only drop this chunk below)
+    except Exception as e:
+        debug_info.append({f"{step_name}_critical_error": traceback.format_exc()})
+        return []
+
+async def _extract_structure_dedup(cache, text_chunk, global_offset, model, safety_settings, prompt_template, debug_info, step_name, semaphore,
+                                   header_re=None, generation_config=GENERATION_CONFIG):
+    # Boilerplate blocks (transitional provisions, short titles) repeat verbatim across chapters;
+    # identical text only costs one LLM call, and the result is shifted to each occurrence's offset.
+    text_chunk = str(text_chunk)
+    key = hashlib.blake2b(prompt_template.encode() + b"\0" + text_chunk.encode(), digest_size=16).digest()
+    if key in cache:
+        debug_info.append({f"{step_name}_dedup_hit": f"Reusing result of identical text at offset {cache[key][0]}"})
+    else:
+        cache[key] = (global_offset, asyncio.ensure_future(_extract_structure(
+            text_chunk, global_offset, model, safety_settings, prompt_template, debug_info, step_name, semaphore, header_re, generation_config)))
+    original_offset, task = cache[key]
+    nodes = await task
+    delta = global_offset - original_offset
+    return [{**node, 'global_start': node['global_start'] + delta} for node in nodes]
 
-    status_container.write(f"1/3: **Architect** - Extracting top-level structure...")
+# --- Pipeline Stages ---
+# Architect -> Surveyor -> Detailer run as a producer/consumer chain connected by bounded queues,
+# so a chapter's sections are detailed while later chapters are still being surveyed.
+
+def _owned_hits(chunks, results, text_len):
+    # Both neighbours see the overlap and may place the same header a few chars apart, so each
+    # chunk only keeps hits up to the middle of its overlap with the next chunk.
+    owned_from = [0] + [(nxt['start_char'] + cur['start_char'] + len(cur['text'])) // 2 for cur, nxt in zip(chunks, chunks[1:])]
+    owned_to = owned_from[1:] + [text_len]
+    return [node for nodes, lo, hi in zip(results, owned_from, owned_to) for node in nodes if lo <= node['global_start'] < hi]
+
+async def architect_producer(document_text, model, safety_settings, prompt_architect, debug_info,
+                             semaphore, out_q, timings, intermediate_callback=None):
     step1_start = time.perf_counter()
-    top_level_nodes_raw = _extract_structure(document_text, 0, model, safety_settings, prompt_architect, debug_info, "step1_architect")
+    if len(document_text) > ARCHITECT_CHUNK_SIZE:
+        # Top-level headers in one piece don't depend on the others.
+        chunks = chunk_text_semantic(document_text, chunk_size_chars=ARCHITECT_CHUNK_SIZE)
+        results = await asyncio.gather(*(
+            _extract_structure(chunk['text'], chunk['start_char'], model, safety_settings, prompt_architect, debug_info,
+                               f"step1_architect_chunk_{i+1}", semaphore, TOP_LEVEL_HEADER_RE, ARCHITECT_GENERATION_CONFIG)
+            for i, chunk in enumerate(chunks)))
+        top_level_nodes_raw = _owned_hits(chunks, results, len(document_text))
+    else:
+        top_level_nodes_raw = await _extract_structure(document_text, 0, model, safety_settings, prompt_architect, debug_info, "step1_architect", semaphore, TOP_LEVEL_HEADER_RE, ARCHITECT_GENERATION_CONFIG)
     
-    if not top_level_nodes_raw or top_level_nodes_raw[0].get('global_start', 0) > 0:
+    if not top_level_nodes_raw or min(node['global_start'] for node in top_level_nodes_raw) > 0:
         top_level_nodes_raw.insert(0, {'type': 'preamble', 'title': 'Preamble', 'global_start': 0})
     
     final_tree = postprocess_nodes(top_level_nodes_raw, document_text, 0)
-    step1_end = time.perf_counter()
-    timings["step1_architect_duration"] = step1_end - step1_start
+    timings["step1_architect_duration"] = time.perf_counter() - step1_start
 
     if intermediate_callback:
         intermediate_callback(final_tree)
-    
-    if not final_tree:
-        return {"error": "Step 1 failed: Could not find any top-level structure."}
 
-    status_container.write(f"2/3: **Surveyor** - Extracting mid-level structure (Sections)...")
-    step2_start = time.perf_counter()
     for i, parent_node in enumerate(final_tree):
         if not parent_node.get('text', '').strip() or parent_node['type'] == 'preamble': continue
-        mid_level_nodes_raw = _extract_structure(parent_node['text'], parent_node['global_start'], model, safety_settings, prompt_surveyor, debug_info, f"step2_surveyor_parent_{i+1}")
+        await out_q.put((parent_node, f"parent_{i+1}"))
+    return final_tree
+
+def build_tree_from_flat_nodes(nodes, document_text):
+    # Nest a flat header list by HIERARCHY_LEVELS; a node ends where the next node at its level or above begins.
+    flat_nodes = postprocess_nodes(nodes, document_text, 0)
+    if not flat_nodes or flat_nodes[0]['global_start'] > 0:
+        flat_nodes.insert(0, {'type': 'preamble', 'title': 'Preamble', 'global_start': 0, 'children': []})
+    roots, stack = [], []
+    level_of, leaf_level = HIERARCHY_LEVELS.get, len(HIERARCHY_LEVELS)
+    for node in flat_nodes:
+        level = level_of(node['type'], leaf_level)
+        # The preamble never has children: like in the cascade, it ends at the first extracted header.
+        while stack and (stack[-1][0] >= level or stack[-1][1]['type'] == 'preamble'):
+            stack.pop()[1]['global_end'] = node['global_start']
+        (stack[-1][1]['children'] if stack else roots).append(node)
+        stack.append((level, node))
+    for _, node in stack:
+        node['global_end'] = len(document_text)
+    for node in flat_nodes:
+        node['text'] = document_text[node['global_start']:node['global_end']]
+    return roots
+
+def _needs_detailing(node):
+    return bool(node.get('text', '').strip()) and node['type'] not in ['preamble', 'article']
+
+def batch_siblings(nodes, max_chars=DETAIL_CHUNK_SIZE_THRESHOLD):
+    # Siblings from postprocess_nodes tile their parent without gaps, so a run of small
+    # consecutive siblings is one contiguous span that a single Detailer call can cover.
+    batches, current, current_len = [], [], 0
+    for i, node in enumerate(nodes):
+        eligible, text_len = _needs_detailing(node), len(node['text'])
+        if not eligible or (current and current_len + text_len > max_chars):
+            if current:
+                batches.append(current)
+            current, current_len = [], 0
+        if eligible:
+            current.append((i, node))
+            current_len += text_len
+    if current:
+        batches.append(current)
+    return batches
+
+async def surveyor_worker(in_q, out_q, model, safety_settings, prompt_surveyor, debug_info, semaphore, cache):
+    while (item := await in_q.get()) is not None:
+        parent_node, label = item
+        mid_level_nodes_raw = await _extract_structure_dedup(cache, parent_node['text'], parent_node['global_start'], model, safety_settings, prompt_surveyor, debug_info, f"step2_surveyor_{label}", semaphore, SECTION_HEADER_RE, SURVEYOR_GENERATION_CONFIG)
         parent_node['children'] = postprocess_nodes(mid_level_nodes_raw, parent_node['text'], parent_node['global_start'])
-    step2_end = time.perf_counter()
-    timings["step2_surveyor_duration"] = step2_end - step2_start
+        if parent_node['children']:
+            for batch in batch_siblings(parent_node['children']):
+                first, last = batch[0][0] + 1, batch[-1][0] + 1
+                nodes = [node for _, node in batch]
+                if first == last:
+                    await out_q.put((nodes, nodes[0]['text'], f"{label}_child_{first}"))
+                else:
+                    # The batch is a contiguous run of the parent, so view it by offsets instead of re-joining.
+                    span_text = TextSlice(parent_node['text'], nodes[0]['global_start'] - parent_node['global_start'],
+                                          nodes[-1]['global_end'] - parent_node['global_start'])
+                    await out_q.put((nodes, span_text, f"{label}_child_{first}-{last}"))
+        elif _needs_detailing(parent_node):
+            await out_q.put(([parent_node], parent_node['text'], label))
+
+async def detailer_worker(in_q, model, safety_settings, prompt_detailer, debug_info, semaphore, cache):
+    while (item := await in_q.get()) is not None:
+        nodes, span_text, label = item
+        all_articles_raw = []
+        span_offset = nodes[0]['global_start']
+        
+        sub_chunks = chunk_text_semantic(str(span_text), chunk_size_chars=DETAIL_CHUNK_SIZE_THRESHOLD) if len(span_text) > DETAIL_CHUNK_SIZE_THRESHOLD else [{'start_char': 0, 'text': span_text}]
+        
+        for j, sub_chunk in enumerate(sub_chunks):
+            chunk_offset = span_offset + sub_chunk['start_char']
+            articles_in_chunk = await _extract_structure_dedup(
+                cache, sub_chunk['text'], chunk_offset, model, safety_settings, prompt_detailer, 
+                debug_info, f"step3_detailer_{label}_subchunk_{j+1}", semaphore, ARTICLE_HEADER_RE, DETAILER_GENERATION_CONFIG
+            )
+            all_articles_raw.extend(articles_in_chunk)
+        # postprocess_nodes scopes by offset, which routes each article to the sibling containing it.
+        for node in nodes:
+            node['children'] = postprocess_nodes(all_articles_raw, node['text'], node['global_start'])
+
+def _stage_llm_seconds(debug_info, step_prefix):
+    return sum(entry.get("llm_duration_seconds", 0.0) for entry in debug_info
+               if any(key.startswith(step_prefix) and key.endswith("_response") for key in entry))
+
+async def _run_single_pass(document_text, model, safety_settings, prompt_single_pass, debug_info, semaphore, timings):
+    step_start = time.perf_counter()
+    nodes_raw = await _extract_structure(document_text, 0, model, safety_settings, prompt_single_pass, debug_info, "step1_single_pass", semaphore, ANY_HEADER_RE, SINGLE_PASS_GENERATION_CONFIG)
+    timings["step1_architect_duration"] = time.perf_counter() - step_start
+    timings["step2_surveyor_duration"] = timings["step3_detailer_duration"] = 0.0
+    return build_tree_from_flat_nodes(nodes_raw, document_text) if nodes_raw else []
+
+async def _run_pipeline_async(document_text, model, safety_settings, status_container,
+                              prompt_architect, prompt_surveyor, prompt_detailer,
+                              debug_info, intermediate_callback=None, semaphore=None,
+                              prompt_single_pass=PROMPT_SINGLE_PASS):
+    timings = {}
+    semaphore = semaphore or asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    if len(document_text) <= SINGLE_PASS_MAX_CHARS:
+        status_container.write("**Single pass** - Document is small enough to extract every header in one LLM call...")
+        pipeline_start = time.perf_counter()
+        final_tree = await _run_single_pass(document_text, model, safety_settings, prompt_single_pass, debug_info, semaphore, timings)
+        if final_tree:
+            if intermediate_callback:
+                intermediate_callback(final_tree)
+            timings["total_pipeline_duration"] = time.perf_counter() - pipeline_start
+            debug_info.append({"performance_timings": timings})
+            return {"tree": final_tree}
+        debug_info.append({"step1_single_pass_fallback": "No headers extracted; falling back to the 3-step pipeline."})
+        timings = {}
+    survey_q = asyncio.Queue(maxsize=QUEUE_MAXSIZE)
+    detail_q = asyncio.Queue(maxsize=QUEUE_MAXSIZE)
+    extraction_cache = {}
+
+    status_container.write(f"**Pipeline** - Architect, Surveyor and Detailer run concurrently (max {MAX_CONCURRENT_REQUESTS} LLM calls in flight)...")
+    pipeline_start = time.perf_counter()
+    async with asyncio.TaskGroup() as detailer_tg:
+        for _ in range(MAX_CONCURRENT_REQUESTS):
+            detailer_tg.create_task(detailer_worker(detail_q, model, safety_settings, prompt_detailer, debug_info, semaphore, extraction_cache))
+
+        async with asyncio.TaskGroup() as surveyor_tg:
+            for _ in range(MAX_CONCURRENT_REQUESTS):
+                surveyor_tg.create_task(surveyor_worker(survey_q, detail_q, model, safety_settings, prompt_surveyor, debug_info, semaphore, extraction_cache))
+            final_tree = await architect_producer(document_text, model, safety_settings, prompt_architect, debug_info,
+                                                  semaphore, survey_q, timings, intermediate_callback)
+            for _ in range(MAX_CONCURRENT_REQUESTS):
+                await survey_q.put(None)
+
+        for _ in range(MAX_CONCURRENT_REQUESTS):
+            await detail_q.put(None)
+    # The stages overlap, so wall-clock splits are meaningless; report each stage's summed LLM time instead.
+    timings["step2_surveyor_duration"] = _stage_llm_seconds(debug_info, "step2_surveyor")
+    timings["step3_detailer_duration"] = _stage_llm_seconds(debug_info, "step3_detailer")
+    timings["total_pipeline_duration"] = time.perf_counter() - pipeline_start
 
-    status_container.write(f"3/3: **Detailer** - Extracting lowest-level structure (Articles)...")
-    step3_start = time.perf_counter()
-    
-    def process_recursively(nodes):
-        for i, node in enumerate(nodes):
-            if node.get('children'):
-                process_recursively(node['children'])
-            elif node.get('text', '').strip() and node['type'] not in ['preamble', 'article']:
-                all_articles_raw = []
-                node_text = node['text']
-                node_offset = node['global_start']
-                
-                sub_chunks = chunk_text_semantic(node_text, chunk_size_chars=DETAIL_CHUNK_SIZE_THRESHOLD) if len(node_text) > DETAIL_CHUNK_SIZE_THRESHOLD else [{'start_char': 0, 'text': node_text}]
-                
-                for j, sub_chunk in enumerate(sub_chunks):
-                    chunk_offset = node_offset + sub_chunk['start_char']
-                    articles_in_chunk = _extract_structure(
-                        sub_chunk['text'], chunk_offset, model, safety_settings, prompt_detailer, 
-                        debug_info, f"step3_detailer_parent_{i+1}_subchunk_{j+1}"
-                    )
-                    all_articles_raw.extend(articles_in_chunk)
-                node['children'] = postprocess_nodes(all_articles_raw, node_text, node_offset)
-
-    process_recursively(final_tree)
-    step3_end = time.perf_counter()
-    timings["step3_detailer_duration"] = step3_end - step3_start
-    
     debug_info.append({"performance_timings": timings})
-    return {"tree": final_tree}
\ No newline at end of file
+    if not final_tree:
+        return {"error": "Step 1 failed: Could not find any top-level structure."}
+    return {"tree": final_tree}
+
+def _create_model(api_key):
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(MODEL_NAME)
+    safety_settings = { "HARM_CATEGORY_HARASSMENT": "BLOCK_NONE", "HARM_CATEGORY_HATE_SPEECH": "BLOCK_NONE",
+                      "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_NONE", "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_NONE" }
+    return model, safety_settings
+
+def _first_error(error):
+    # Surface the first worker failure (e.g. exhausted InternalServerError retries) as before.
+    while isinstance(error, ExceptionGroup):
+        error = error.exceptions[0]
+    return error
+
+def _run_and_unwrap(coro):
+    try:
+        return asyncio.run(coro)
+    except ExceptionGroup as eg:
+        raise _first_error(eg)
+
+def run_pipeline(document_text, api_key, status_container, 
+                 prompt_architect, prompt_surveyor, prompt_detailer,
+                 debug_info, intermediate_callback=None, prompt_single_pass=PROMPT_SINGLE_PASS):
+    model, safety_settings = _create_model(api_key)
+    return _run_and_unwrap(_run_pipeline_async(
+        document_text, model, safety_settings, status_container,
+        prompt_architect, prompt_surveyor, prompt_detailer,
+        debug_info, intermediate_callback, prompt_single_pass=prompt_single_pass
+    ))
+
+async def _run_pipelines_async(document_texts, model, safety_settings, status_container,
+                               prompt_architect, prompt_surveyor, prompt_detailer, debug_infos,
+                               prompt_single_pass=PROMPT_SINGLE_PASS):
+    # One semaphore across all documents keeps the combined in-flight calls under the RPM limit.
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def run_one(text, debug_info):
+        # A failing document must not cancel the others, so its error becomes its result.
+        try:
+            return await _run_pipeline_async(
+                text, model, safety_settings, status_container,
+                prompt_architect, prompt_surveyor, prompt_detailer,
+                debug_info, semaphore=semaphore, prompt_single_pass=prompt_single_pass)
+        except Exception as e:
+            error = _first_error(e)
+            debug_info.append({"pipeline_error": "".join(traceback.format_exception(error))})
+            return {"error": f"{type(error).__name__}: {error}"}
+
+    return await asyncio.gather(*(run_one(text, debug_info) for text, debug_info in zip(document_texts, debug_infos)))
+
+def run_pipelines(document_texts, api_key, status_container,
+                  prompt_architect, prompt_surveyor, prompt_detailer, debug_infos,
+                  prompt_single_pass=PROMPT_SINGLE_PASS):
+    """Runs the pipeline over several documents concurrently; results keep the input order.
+
+    A document that fails gets an {"error": ...} result instead of aborting the whole batch.
+    """
+    model, safety_settings = _create_model(api_key)
+    return _run_and_unwrap(_run_pipelines_async(
+        document_texts, model, safety_settings, status_container,
+        prompt_architect, prompt_surveyor, prompt_detailer, debug_infos,
+        prompt_single_pass=prompt_single_pass
+    ))